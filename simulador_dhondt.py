@@ -3,20 +3,43 @@
 # - Editor en un st.form + botón "Recalcular" => asegura el rerun
 # - Usa st.data_editor o st.experimental_data_editor según tu versión
 # - Colores únicos por partido
-# - Reparto D'Hondt
+# - Reparto D'Hondt (núcleo compilado con Numba si está instalado)
 # - Cuadro de cocientes ÷1..÷4 con top-4 resaltado
 
-import io
-import hashlib
+import json
+import zlib
+import functools
+import numpy as np
 import pandas as pd
 import streamlit as st
+import matplotlib
+matplotlib.use("Agg")  # sin GUI: backend más rápido para Streamlit
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+# orjson es opcional: sin él, la descarga JSON usa el módulo json estándar
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Numba es opcional: sin él, el núcleo D'Hondt usa la versión vectorizada con NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 st.set_page_config(page_title="Simulador D'Hondt (Perú)", page_icon="🧮", layout="wide")
 st.title("🧮 Simulador de Cifra Repartidora (D’Hondt) – Perú")
 
 REQUIRED_COLS = ["Partido", "Votos"]
 
+# Paleta tab20 como tabla (20, 3) RGB: se indexa directo, sin pasar por el Colormap
+TAB20 = np.asarray(plt.cm.tab20.colors, dtype=np.float32)
+
 INIT = [
     {"Partido": "Fuerza Popular",  "Votos": 71758},
     {"Partido": "Peru Libre",      "Votos": 42691},
@@ -27,8 +50,11 @@ INIT = [
 
 # ---------------- Helpers ----------------
 def to_df(obj) -> pd.DataFrame:
+    # Ya conforme (caso habitual del editor): se devuelve tal cual, sin copiar
+    if isinstance(obj, pd.DataFrame) and list(obj.columns) == REQUIRED_COLS and obj["Votos"].dtype.kind == "i":
+        return obj
     if isinstance(obj, pd.DataFrame):
-        df = obj.copy()
+        df = obj  # rename() ya devuelve un objeto nuevo
     elif isinstance(obj, list):
         df = pd.DataFrame(obj)
     elif isinstance(obj, dict):
@@ -53,38 +79,118 @@ def to_df(obj) -> pd.DataFrame:
     for col in REQUIRED_COLS:
         if col not in df.columns:
             df[col] = 0 if col == "Votos" else ""
-    return df[REQUIRED_COLS]
+    return df.reindex(columns=REQUIRED_COLS)  # objeto nuevo: sanitize puede mutarlo
 
 def sanitize(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    # Modifica df en el lugar (to_df ya entrega un objeto propio)
     df["Partido"] = df["Partido"].fillna("").astype(str)
-    df["Votos"] = pd.to_numeric(df["Votos"], errors="coerce").fillna(0).clip(lower=0).round().astype(int)
+    df["Votos"] = pd.to_numeric(df["Votos"], errors="coerce").fillna(0).clip(lower=0).round().astype(np.int64)
     return df
 
-def dhondt(df_: pd.DataFrame, seats_: int):
+def votes_array(df_: pd.DataFrame) -> np.ndarray:
+    # Votos como ndarray int64 1-D (to_numpy ya lo entrega contiguo)
+    return df_["Votos"].to_numpy(dtype=np.int64)
+
+if njit is not None:
+    @njit(cache=True)
+    def dhondt_core(votes, seats):
+        alloc = np.zeros(votes.shape, np.int64)
+        cur = votes.astype(np.float64).copy()
+        for _ in range(seats):
+            w = np.argmax(cur)
+            alloc[w] += 1
+            cur[w] = votes[w] / (alloc[w] + 1)
+        return alloc
+else:
+    def dhondt_core(votes, seats):
+        flat = (votes[:, None] / np.arange(1, seats + 1)[None, :]).ravel()
+        thr = np.partition(flat, -seats)[-seats]
+        win = flat > thr
+        # Empates en el umbral: gana el partido anterior, igual que el bucle compilado
+        win[np.flatnonzero(flat == thr)[:seats - int(win.sum())]] = True
+        return np.bincount(np.flatnonzero(win) // seats, minlength=len(votes))
+
+def dhondt(df_: pd.DataFrame, seats_: int) -> pd.Series:
+    if df_.empty or seats_ <= 0:
+        return pd.Series(dtype=int)
+    votes = votes_array(df_)
+    return pd.Series(dhondt_core(votes, seats_), index=df_.index, dtype=int)
+
+@st.cache_data(show_spinner=False)
+def dhondt_trace(df_: pd.DataFrame, seats_: int) -> pd.DataFrame:
+    # Tabla completa de cocientes ordenada (solo para mostrar el trazado)
     if df_.empty or seats_ <= 0:
-        return pd.Series(dtype=int), pd.DataFrame(columns=["Partido","Divisor","Cociente","Rank","GanaEscaño"])
-    rows = []
-    for idx, r in df_.iterrows():
-        v = int(r["Votos"])
-        for d in range(1, seats_ + 1):
-            rows.append({"idx": idx, "Partido": r["Partido"], "Divisor": d, "Cociente": v / d})
-    q = pd.DataFrame(rows).sort_values("Cociente", ascending=False, ignore_index=True)
+        return pd.DataFrame(columns=["Partido","Divisor","Cociente","Rank","GanaEscaño"])
+    votes = votes_array(df_)
+    divs = np.arange(1, seats_ + 1)
+    flat = (votes[:, None] / divs[None, :]).ravel()
+    order = np.argsort(-flat, kind="stable")
+    q = pd.DataFrame({
+        "Partido": np.repeat(df_["Partido"].to_numpy(), seats_)[order],
+        "Divisor": np.tile(divs, len(votes))[order],
+        "Cociente": flat[order],
+    })
     q["Rank"] = q.index + 1
     q["GanaEscaño"] = q["Rank"] <= seats_
-    alloc = pd.Series(0, index=df_.index, dtype=int)
-    for _, r in q[q["GanaEscaño"]].iterrows():
-        alloc.loc[r["idx"]] += 1
-    return alloc, q
+    return q
 
-def color_for(name: str):
-    h = int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16)
-    t = (h % 1000) / 1000.0
-    return plt.cm.tab20(t % 1.0)
+def quotient_top4(df_):
+    divisores = np.array([1, 2, 3, 4], dtype=np.int64)
+    cols = [f"÷{d}" for d in divisores]
+    votes = votes_array(df_)
+    M = np.rint(votes[:, None] / divisores[None, :]).astype(np.int64)
+    m_int = pd.DataFrame(M, index=df_["Partido"], columns=cols)
+
+    # Top 4 globales (máscara posicional, sin etiquetas)
+    flat = M.ravel()
+    k = min(4, flat.size)
+    mask = np.zeros_like(M, dtype=bool)
+    if k:
+        rows, cols_ = np.divmod(np.argpartition(flat, -k)[-k:], M.shape[1])
+        mask[rows, cols_] = True
+    return m_int, mask
+
+@functools.lru_cache(maxsize=None)
+def color_slot(name: str) -> int:
+    # crc32: rápido y estable entre reinicios (hash() de str cambia por proceso)
+    return zlib.crc32(name.encode("utf-8")) % len(TAB20)
+
+@st.cache_data(show_spinner=False)
+def compute(parties: tuple, votes: tuple, seats: int) -> dict:
+    # Todo lo que depende solo de los datos y los escaños; el toggle del gráfico no lo invalida
+    df_ = pd.DataFrame({"Partido": list(parties), "Votos": np.array(votes, dtype=np.int64)})
+    total = int(df_["Votos"].sum())
+    inv = (100.0 / total) if total else 0.0  # sin votos => 0 %, sin NaN que reparar
+    m_int, mask = quotient_top4(df_)
+    alloc = dhondt(df_, seats).to_numpy()
+    v = df_["Votos"].to_numpy()
+    names = np.array(parties, dtype=object)
+    # Ganadores (Escaños desc, Partido asc) ya indexados por Partido, listos para st.table
+    won = np.flatnonzero(alloc > 0)
+    won = won[np.lexsort((names[won], -alloc[won]))]
+    # Un color por nombre distinto y luego un take por códigos (sin buscar cada fila)
+    codes, uniques = pd.factorize(names)
+    slots = np.fromiter((color_slot(p) for p in uniques), dtype=np.intp, count=len(uniques))
+    return {
+        "total": total,
+        "alloc": alloc,
+        # Orden del gráfico (Votos desc, Escaños desc, Partido asc) calculado una sola vez
+        "perm": np.lexsort((names, -alloc, -v)),
+        "winners": pd.DataFrame({"Escaños": alloc[won]}, index=pd.Index(names[won], name="Partido")),
+        "pct": np.round(v * inv, 2),
+        "colors": TAB20[slots][codes],
+        "quot_matrix": m_int,
+        "top4_mask": mask,
+    }
 
 # ---------------- Estado inicial ----------------
 if "store_df" not in st.session_state:
     st.session_state.store_df = pd.DataFrame(INIT, columns=REQUIRED_COLS)
+if "fig" not in st.session_state:
+    # Fuera de pyplot (no queda en el gestor global). constrained_layout deja espacio a las
+    # etiquetas rotadas y al xlabel; dpi=200 iguala la resolución que daba st.pyplot
+    fig = Figure(figsize=(10, 4), dpi=200, constrained_layout=True)
+    st.session_state.fig, st.session_state.ax = fig, fig.subplots()
 
 # ---------------- Sidebar ----------------
 with st.sidebar:
@@ -124,82 +230,100 @@ if submitted:
     st.session_state.store_df = sanitize(to_df(edited_df))
 
 # Fuente de la verdad SIEMPRE
-df = st.session_state.store_df.copy()
+df = st.session_state.store_df  # solo lectura: assign() crea la única copia
 
 # ---------------- Cálculos ----------------
-total_votes = int(df["Votos"].sum())
-df["%"] = (df["Votos"] / total_votes * 100.0).fillna(0).round(2)
-alloc, qdf = dhondt(df, int(seats))
-df["Escaños"] = alloc
+# Clave de caché (Partido, Votos) armada una sola vez y compartida por todas las funciones cacheadas
+key = (tuple(df["Partido"]), tuple(df["Votos"]))
+res = compute(*key, int(seats))
+total_votes = res["total"]
+df = df.assign(**{"%": res["pct"], "Escaños": res["alloc"]})
 
 # ---------------- Visualización ----------------
 c1, c2 = st.columns([2, 1], gap="large")
 
 with c1:
     st.subheader("📊 Gráfico de votos (colores únicos por partido)")
-    plot_df = df.sort_values(["Votos", "Escaños", "Partido"], ascending=[False, False, True]) if order_chart else df
-    color_map = {p: color_for(p) for p in df["Partido"]}
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.bar(plot_df["Partido"], plot_df["Votos"], color=[color_map[p] for p in plot_df["Partido"]])
+    plot_df = df.take(res["perm"]) if order_chart else df
+    colors = res["colors"][res["perm"]] if order_chart else res["colors"]
+    fig, ax = st.session_state.fig, st.session_state.ax
+    ax.cla()
+    # Una sola colección de rectángulos (un draw call) en lugar de un artista por barra
+    n = len(plot_df)
+    rects = [Rectangle((i - 0.4, 0), 0.8, v) for i, v in enumerate(plot_df["Votos"])]
+    ax.add_collection(PatchCollection(rects, facecolors=colors, snap=True))
+    ax.set_xlim(-0.5, max(n, 1) - 0.5)
+    ax.set_ylim(0, max(int(plot_df["Votos"].max()) if n else 0, 1) * 1.05)
+    ax.set_xticks(range(n)); ax.set_xticklabels(plot_df["Partido"])
     ax.set_xlabel("Partido"); ax.set_ylabel("Votos")
     ax.tick_params(axis="x", rotation=30)
-    st.pyplot(fig, clear_figure=True)
+    # Render directo del canvas Agg (sin savefig; st.image sigue codificando a PNG)
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    st.image(np.asarray(canvas.buffer_rgba()))
 
 with c2:
     st.subheader("ℹ️ Totales")
     st.metric("Total de votos", f"{total_votes:,}".replace(",", "."))
-    winners = df[df["Escaños"] > 0][["Partido","Escaños"]].sort_values(["Escaños","Partido"], ascending=[False, True])
+    winners = res["winners"]
     if winners.empty:
         st.caption("(Sin asignaciones)")
     else:
-        st.table(winners.set_index("Partido"))
+        st.table(winners)
 
 
 
 # ---------------- Cuadro de cocientes ÷1..÷4 con top-4 resaltado ----------------
 st.subheader("🔍 Cocientes D’Hondt por partido (÷1, ÷2, ÷3, ÷4)")
 
-def quotient_matrix_top4(df_):
-    divisores = [1, 2, 3, 4]
-    cols = [f"÷{d}" for d in divisores]
-    m = pd.DataFrame(index=df_["Partido"], columns=cols, dtype=float)
-    for _, r in df_.iterrows():
-        for d in divisores:
-            m.at[r["Partido"], f"÷{d}"] = r["Votos"] / d
-    m_int = m.round(0).astype(int)
-
-    # Top 4 globales
-    flat = m_int.stack().sort_values(ascending=False).head(4)
-    mask = pd.DataFrame(False, index=m_int.index, columns=m_int.columns)
-    for idx, col in flat.index:
-        mask.loc[idx, col] = True
-
-    def highlight(row):
-        row_index = row.name
-        return [
-            "background-color: #1f6feb; color: white; font-weight: bold; border: 2px solid #0b4eda"
-            if mask.loc[row_index, col] else ""
-            for col in row.index
-        ]
+@st.cache_data(show_spinner=False)
+def quotient_html(parties: tuple, votes: tuple, _m_int, _mask) -> str:
+    # HTML ya serializado y cacheado solo por los datos (no depende de los escaños);
+    # _m_int/_mask salen de compute() y no entran en la clave del caché
+    m_int, mask = _m_int, _mask
+
+    # CSS de todas las celdas en un solo np.where (una única llamada al Styler)
+    css = np.where(mask, "background-color: #1f6feb; color: white; font-weight: bold; border: 2px solid #0b4eda", "")
+    css_df = pd.DataFrame(css, index=m_int.index, columns=m_int.columns)
 
     # Si pandas no soporta estilos, mostramos sin resaltado
     try:
+        # Los nombres los escribe el usuario: se escapan antes de ir a unsafe_allow_html
         styled = (m_int.style
-                  .apply(highlight, axis=1)
+                  .format(escape="html")
+                  .format_index(escape="html")
+                  .apply(lambda _: css_df, axis=None)
                   .set_properties(**{"text-align": "center"})
                   .set_table_styles([{"selector": "th", "props": [("text-align", "center"), ("font-weight", "bold")]}]))
-        return styled
+        return styled.to_html()
     except Exception:
         st.warning("Tu versión de pandas no soporta estilos; mostrando la tabla sin resaltado.")
-        return m_int
+        return m_int.to_html()
 
-st.write(quotient_matrix_top4(df))
+st.markdown(quotient_html(*key, res["quot_matrix"], res["top4_mask"]),
+            unsafe_allow_html=True)
+
+if st.checkbox("Mostrar trazado"):
+    st.dataframe(dhondt_trace(df, int(seats)), use_container_width=True, hide_index=True)
 
 # ---------------- Descargas ----------------
-def to_csv_bytes(df_):
-    s = io.StringIO(); df_[["Partido","Votos"]].to_csv(s, index=False); return s.getvalue().encode("utf-8")
-def to_json_bytes(df_):
-    s = io.StringIO(); df_[["Partido","Votos"]].to_json(s, orient="records", force_ascii=False); return s.getvalue().encode("utf-8")
+def csv_field(text: str) -> str:
+    # Comillas solo cuando hacen falta (mismo criterio QUOTE_MINIMAL que pandas)
+    if any(c in text for c in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(parties: tuple, votes: tuple):
+    out = ["Partido,Votos\n"]
+    out.extend(f"{csv_field(p)},{int(v)}\n" for p, v in zip(parties, votes))
+    return "".join(out).encode("utf-8")
+@st.cache_data(show_spinner=False)
+def to_json_bytes(parties: tuple, votes: tuple):
+    records = [{"Partido": p, "Votos": int(v)} for p, v in zip(parties, votes)]
+    if orjson is not None:
+        return orjson.dumps(records)
+    return json.dumps(records, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
-st.download_button("⬇️ CSV (Partidos,Votos)", data=to_csv_bytes(df), file_name="partidos_votos.csv", mime="text/csv")
-st.download_button("⬇️ JSON", data=to_json_bytes(df), file_name="partidos_votos.json", mime="application/json")
+st.download_button("⬇️ CSV (Partidos,Votos)", data=to_csv_bytes(*key), file_name="partidos_votos.csv", mime="text/csv")
+st.download_button("⬇️ JSON", data=to_json_bytes(*key), file_name="partidos_votos.json", mime="application/json")